@@ -1,13 +1,27 @@
 import logging
 import os
+import re
+import shutil
 import subprocess
 import tempfile
 import threading
+import time
 import asyncio
-import uuid 
-from flask import Flask, request, jsonify
-from telegram import Bot
-from waitress import serve
+import contextlib
+import glob
+import atexit
+import hmac
+import mmap
+import signal
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+import uvicorn
+from quart import Quart, request, jsonify
+from telegram import Bot, InputFile
+from telegram.request import HTTPXRequest
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadCancelled, DownloadError
 
 # --- 日誌設定 ---
 logging.basicConfig(
@@ -16,17 +30,307 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# --- Flask App 初始化 ---
-app = Flask(__name__)
+# --- Quart App 初始化 ---
+# 原生 ASGI 應用，路由協程直接在伺服器的事件迴圈上執行，不需經過 WSGI 轉接層
+app = Quart(__name__)
 
 # --- 從環境變數獲取配置 ---
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 KOYEB_SECRET = os.getenv('KOYEB_SECRET')
+KOYEB_SECRET_BYTES = KOYEB_SECRET.encode() if KOYEB_SECRET else None # 預先編碼，每次驗證時不必重複 encode
 COOKIES_PATH = os.getenv('COOKIES_PATH', '/app/cookies.txt') # 讓 cookies 路徑可配置
+CONCURRENT_FRAGMENTS = int(os.getenv('CONCURRENT_FRAGMENTS', '4')) # DASH/HLS 分段的並行下載數
+MAX_JOBS = int(os.getenv('MAX_JOBS', str(min(4, os.cpu_count() or 1)))) # 同時處理的下載任務上限
+DOWNLOAD_TIMEOUT = int(os.getenv('DOWNLOAD_TIMEOUT', '300')) # 單次 yt-dlp 下載的總時限 (秒)
+MAX_QUEUED_JOBS = int(os.getenv('MAX_QUEUED_JOBS', str(MAX_JOBS * 4))) # 包含排隊中的任務總上限，超過時回應 503
+MIN_TMP_FREE_MB = int(os.getenv('MIN_TMP_FREE_MB', '100')) # 暫存目錄剩餘空間低於此值時拒絕新任務
+# /dev/shm 總容量至少要能同時放下原始檔與壓縮後的檔案才使用，Docker 預設只有 64MB
+MIN_TMPFS_MB = int(os.getenv('MIN_TMPFS_MB', '512'))
 
-# --- Flask 路由 ---
+def pick_tmpdir():
+    """
+    選擇暫存目錄：優先使用 RAM 上的 tmpfs (/dev/shm)，下載、壓縮與上傳都不必經過磁碟；
+    /dev/shm 不存在、不可寫入或容量不足時改用 tempfile.gettempdir()。可用 TMPDIR 環境變數覆寫。
+    """
+    shm = '/dev/shm'
+    try:
+        if os.access(shm, os.W_OK) and shutil.disk_usage(shm).total >= MIN_TMPFS_MB << 20:
+            return shm
+    except OSError:
+        pass
+    return tempfile.gettempdir()
+
+TMPDIR = os.getenv('TMPDIR') or pick_tmpdir()
+
+# 外部工具路徑只在啟動時解析一次，之後每次 fork 都直接使用絕對路徑
+FFMPEG_BIN = shutil.which('ffmpeg') or 'ffmpeg'
+# 只讓 FFmpeg 在 stderr 輸出錯誤訊息，不輸出進度與串流資訊，避免在記憶體中累積大量輸出
+FFMPEG_QUIET_ARGS = ['-hide_banner', '-nostats', '-loglevel', 'error']
+
+# --- 檔案大小限制 ---
+COMPRESS_THRESHOLD_MB = 48  # 留一點緩衝空間給 Telegram 的 50MB 限制
+COMPRESS_THRESHOLD_BYTES = COMPRESS_THRESHOLD_MB << 20
+TELEGRAM_UPLOAD_LIMIT_BYTES = 50 << 20
+# 編碼時交給 FFmpeg -fs 的硬性上限；FFmpeg 可能略為超寫，+faststart 也會再加上 moov，因此保留 2MB 緩衝
+ENCODE_SIZE_CAP_BYTES = COMPRESS_THRESHOLD_BYTES - (2 << 20)
+AUDIO_BITRATE_K = 96  # 語音與一般音樂已足夠，省下的位元率留給視訊
+FALLBACK_VIDEO_BITRATE_K = 1200  # 無法得知影片長度時使用的視訊位元率上限
+
+def safe_stat(path):
+    """以單次 stat 取得檔案資訊，檔案不存在時返回 None，取代 exists + getsize 兩次系統呼叫。"""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+# --- yt-dlp 設定 ---
+# 直接在行程內使用 yt-dlp 的 Python API，避免每次請求都 fork 一個新的直譯器並重新載入 extractor
+YDL_OPTS = {
+    'format': 'bv*[height<=720]+ba/b[height<=720]',
+    'merge_output_format': 'mp4',
+    'max_filesize': 750 << 20,
+    'socket_timeout': 30,
+    'retries': 3,
+    'concurrent_fragment_downloads': CONCURRENT_FRAGMENTS,
+    'overwrites': True,
+    'quiet': True,
+    'no_warnings': True,
+    'noprogress': True,
+    'logger': logger,
+}
+# 讓 yt-dlp 合併影音時直接使用已解析的 ffmpeg 絕對路徑，不再每次經由 PATH 搜尋
+if os.path.isabs(FFMPEG_BIN):
+    YDL_OPTS['ffmpeg_location'] = FFMPEG_BIN
+
+def apply_cookies_opt():
+    """依 cookies 檔案目前的狀態設定 YDL_OPTS，檔案存在且非空時才使用。"""
+    cookies_stat = safe_stat(COOKIES_PATH)
+    if cookies_stat and cookies_stat.st_size > 0:
+        YDL_OPTS['cookiefile'] = COOKIES_PATH
+    else:
+        YDL_OPTS.pop('cookiefile', None)
+
+# cookies 只在啟動時檢查一次，之後需更新時對行程送出 SIGHUP 重新載入
+apply_cookies_opt()
+
+class DownloadDeadline:
+    """
+    YoutubeDL 實例的下載時限，作為 progress hook 安裝，超過時限時由 yt-dlp 自行中止下載並釋放執行緒。
+    時限存放在 hook 物件上而非 thread-local，分段並行下載時在其他執行緒呼叫的 hook 也能檢查到。
+    """
+
+    def __init__(self):
+        self.expires_at = None
+
+    def __call__(self, progress):
+        if self.expires_at is not None and time.monotonic() > self.expires_at:
+            raise DownloadCancelled(f"下載超時 (超過 {DOWNLOAD_TIMEOUT} 秒)。")
+
+# 每個工作執行緒各持有一個 YoutubeDL 實例，跨請求重用 extractor 狀態、HTTP session 與 cookiejar
+_ydl_local = threading.local()
+# 設定變更時遞增，各執行緒在下次取用時會以新設定重建自己的 YoutubeDL
+_ydl_generation = 0
+
+def get_ydl():
+    """取得當前執行緒專屬的 YoutubeDL 實例，首次呼叫或設定變更後才建立。"""
+    ydl = getattr(_ydl_local, 'ydl', None)
+    if ydl is None or _ydl_local.generation != _ydl_generation:
+        deadline = DownloadDeadline()
+        ydl = YoutubeDL({**YDL_OPTS, 'progress_hooks': [deadline]})
+        _ydl_local.ydl = ydl
+        _ydl_local.deadline = deadline
+        _ydl_local.generation = _ydl_generation
+    return ydl
+
+def reload_cookies(signum=None, frame=None):
+    """SIGHUP 處理函式：重新檢查 cookies 檔案，並讓所有執行緒改用新設定建立 YoutubeDL。"""
+    global _ydl_generation
+    apply_cookies_opt()
+    _ydl_generation += 1
+    logger.info(f"已重新載入 cookies 設定 (使用 cookies: {'cookiefile' in YDL_OPTS})")
+
+# --- Telegram Bot 與共用事件迴圈 ---
+# 單一背景事件迴圈搭配單一 Bot，讓 httpx 連線池與 TLS 連線在請求之間保持存活
+LOOP = asyncio.new_event_loop()
+threading.Thread(target=LOOP.run_forever, name='telegram-loop', daemon=True).start()
+
+# 放大連線池並延長等待時間，避免並發上傳時出現連線池耗盡 (pool timeout)
+TELEGRAM_REQUEST = HTTPXRequest(
+    connection_pool_size=64,
+    read_timeout=120,
+    write_timeout=120,
+    pool_timeout=30,
+)
+BOT = Bot(token=TELEGRAM_TOKEN, request=TELEGRAM_REQUEST) if TELEGRAM_TOKEN else None
+
+def run_on_loop(coro):
+    """將協程提交到共用事件迴圈執行，並阻塞等待其結果。"""
+    return asyncio.run_coroutine_threadsafe(coro, LOOP).result()
+
+def init_bot():
+    """初始化 Bot 的連線資源並驗證 Token；失敗時僅記錄錯誤，不阻止服務啟動。"""
+    if BOT is None:
+        return
+    try:
+        run_on_loop(BOT.initialize())
+    except Exception as e:
+        logger.error(f"初始化 Telegram Bot 失敗: {e}")
+
+@atexit.register
+def shutdown_bot():
+    """行程結束時關閉 Bot 的 httpx 連線池。"""
+    if BOT is not None and LOOP.is_running():
+        run_on_loop(BOT.shutdown())
+
+# --- 進行中的下載任務 ---
+# 以影片 ID 為鍵記錄正在處理的 asyncio.Task，同一影片的並發請求只會下載與上傳一次
+# 只在共用事件迴圈 LOOP 上存取，且查詢與登記之間沒有 await，因此不需要額外加鎖
+INFLIGHT = {}
+
+# --- 背景下載任務 ---
+# 下載流程以協程在共用事件迴圈 LOOP 上執行，JOB_SLOTS 限制同時進行的下載/轉碼數量，超出的請求會排隊等待
+JOB_SLOTS = asyncio.Semaphore(MAX_JOBS)
+# 限制已接受 (執行中加上排隊中) 的任務總數，佇列滿時直接拒絕新請求，避免無限堆積
+QUEUE_DEPTH = threading.BoundedSemaphore(MAX_QUEUED_JOBS)
+# yt-dlp 的 Python API 是阻塞式的，交由固定大小的執行緒池執行
+# 每個工作執行緒啟動時就建立自己的 YoutubeDL，不必等到處理第一個請求時才建立
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_JOBS, thread_name_prefix='dl', initializer=get_ydl)
+
+def warmup():
+    """
+    在開始接受請求前預先載入 yt-dlp 的 YouTube extractor 並檢查外部工具，
+    讓第一個 /wake 請求與之後的請求一樣快。
+    """
+    YoutubeDL(dict(YDL_OPTS)).get_info_extractor('Youtube')
+    sweep_job_tempdirs()
+    if not os.path.isabs(FFMPEG_BIN):
+        logger.warning("找不到 ffmpeg，影片合併與壓縮將無法進行。")
+    logger.info("預熱完成。")
+
+# --- 網址預先檢查 ---
+# 在交給 yt-dlp 之前先排除非 YouTube 網址，避免無效請求佔用下載槽位與網路請求時間
+_YT_HOSTS = frozenset({'www.youtube.com', 'youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtu.be'})
+_YT_VIDEO_ID_RE = re.compile(r'[\w-]{11}')
+
+def is_supported_url(url):
+    """檢查是否為 http(s) 的 YouTube 網址；網址中帶有影片 ID 時一併檢查其格式。"""
+    if not isinstance(url, str):
+        return False
+    try:
+        parsed = urlparse(url)
+        hostname = parsed.hostname
+    except ValueError:
+        return False
+    if parsed.scheme not in ('http', 'https') or hostname not in _YT_HOSTS:
+        return False
+    if hostname == 'youtu.be':
+        video_id = parsed.path.lstrip('/').split('/')[0]
+    else:
+        video_id = parse_qs(parsed.query).get('v', [None])[0]
+        if video_id is None:
+            return True
+    return bool(_YT_VIDEO_ID_RE.fullmatch(video_id))
+
+# --- Telegram file_id 快取 ---
+# 影片上傳後 Telegram 會回傳 file_id，之後相同影片只需引用該 id，無須重新下載、壓縮與上傳
+# 快取項目為 (file_id, 是否被截斷)，轉發時才能附上與首次發送相同的截斷提醒
+FILE_ID_CACHE_SIZE = 1024
+_YT_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([\w-]{11})')
+_file_id_cache = OrderedDict()
+_file_id_cache_lock = threading.Lock()
+
+def extract_video_id(url):
+    """從 YouTube 網址擷取 11 碼影片 ID；無法辨識時直接以原網址作為快取鍵。"""
+    match = _YT_ID_RE.search(url)
+    return match.group(1) if match else url
+
+def get_cached_file_id(video_key):
+    """查詢快取中的 (file_id, 是否被截斷)，命中時將其標記為最近使用。"""
+    with _file_id_cache_lock:
+        entry = _file_id_cache.get(video_key)
+        if entry is not None:
+            _file_id_cache.move_to_end(video_key)
+        return entry
+
+def cache_file_id(video_key, file_id, truncated):
+    """寫入 file_id 快取，超過容量時淘汰最久未使用的項目。"""
+    with _file_id_cache_lock:
+        _file_id_cache[video_key] = (file_id, truncated)
+        _file_id_cache.move_to_end(video_key)
+        if len(_file_id_cache) > FILE_ID_CACHE_SIZE:
+            _file_id_cache.popitem(last=False)
+
+def discard_cached_file_id(video_key):
+    """移除已失效的 file_id。"""
+    with _file_id_cache_lock:
+        _file_id_cache.pop(video_key, None)
+
+# --- H.264 編碼器偵測 ---
+# 依序偏好的硬體編碼器；啟動時偵測一次並快取結果，避免每次請求都 fork ffmpeg
+HW_ENCODER_CANDIDATES = ('h264_nvenc', 'h264_qsv', 'h264_vaapi', 'h264_videotoolbox')
+VAAPI_DEVICE = '/dev/dri/renderD128'
+
+def detect_h264_encoder():
+    """
+    偵測可用的 H.264 硬體編碼器，找不到時返回 None (使用 libx264)。
+    ffmpeg 列出的編碼器不代表主機上真的有對應硬體，因此會以極短的測試編碼確認。
+    """
+    try:
+        result = subprocess.run(
+            [FFMPEG_BIN, '-hide_banner', '-encoders'], check=True, timeout=10, capture_output=True, text=True
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"無法列出 FFmpeg 編碼器，改用 libx264: {e}")
+        return None
+
+    for encoder in HW_ENCODER_CANDIDATES:
+        if not re.search(rf'\b{encoder}\b', result.stdout):
+            continue
+        if encoder == 'h264_vaapi' and not os.path.exists(VAAPI_DEVICE):
+            continue
+        test_cmd = [
+            FFMPEG_BIN, '-hide_banner', *hw_device_args(encoder),
+            '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1',
+            *video_encoder_args(encoder), '-f', 'null', '-'
+        ]
+        try:
+            subprocess.run(test_cmd, check=True, timeout=20, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            logger.info(f"使用硬體編碼器: {encoder}")
+            return encoder
+        except (OSError, subprocess.SubprocessError):
+            logger.info(f"硬體編碼器 {encoder} 無法使用，略過。")
+    return None
+
+def hw_device_args(encoder):
+    """返回指定編碼器所需的全域硬體裝置參數。"""
+    if encoder == 'h264_vaapi':
+        return ['-vaapi_device', VAAPI_DEVICE]
+    return []
+
+def video_encoder_args(encoder, bitrate_k=None):
+    """
+    產生 FFmpeg 視訊編碼參數。
+    bitrate_k 為 None 時使用固定品質模式；否則以該位元率為目標並限制峰值 (libx264 則僅作為上限)。
+    """
+    hw_rate = ['-b:v', f'{bitrate_k}k', '-maxrate', f'{bitrate_k}k', '-bufsize', f'{bitrate_k * 2}k'] if bitrate_k else []
+    if encoder == 'h264_nvenc':
+        return ['-c:v', 'h264_nvenc', '-preset', 'p4', '-rc', 'vbr', *(hw_rate or ['-cq', '28'])]
+    if encoder == 'h264_qsv':
+        return ['-c:v', 'h264_qsv', *(hw_rate or ['-global_quality', '28'])]
+    if encoder == 'h264_vaapi':
+        return ['-vf', 'format=nv12,hwupload', '-c:v', 'h264_vaapi', *(hw_rate or ['-qp', '28'])]
+    if encoder == 'h264_videotoolbox':
+        return ['-c:v', 'h264_videotoolbox', *(hw_rate or ['-q:v', '60'])]
+    # CPU 備援：ultrafast 犧牲少量壓縮率換取數倍的編碼速度
+    # zerolatency 關閉 lookahead 與 B 幀並改用 sliced threads，所有核心可同時編碼同一幀
+    rate = ['-maxrate', f'{bitrate_k}k', '-bufsize', f'{bitrate_k * 2}k'] if bitrate_k else []
+    return ['-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-crf', '26', '-threads', '0', *rate]
+
+H264_ENCODER = detect_h264_encoder()
+
+# --- Quart 路由 ---
 @app.route('/')
-def home():
+async def home():
     """根路徑，用於服務健康檢查或基本資訊。"""
     return jsonify({
         'status': 'ok',
@@ -35,14 +339,14 @@ def home():
     })
 
 @app.route('/health')
-def health_check():
+async def health_check():
     """健康檢查端點。"""
     return jsonify({'status': 'healthy'}), 200
 
 @app.route('/wake', methods=['POST'])
-def wake_handler():
+async def wake_handler():
     """
-    主工作端點，接收請求並在背景執行緒中處理下載任務。
+    主工作端點，接收請求並將下載任務交由共用事件迴圈 LOOP 以協程在背景處理。
     """
     # 驗證授權
     auth_header = request.headers.get('Authorization', '')
@@ -50,13 +354,14 @@ def wake_handler():
         logger.warning("未經授權的請求：缺少 Bearer Token。")
         return jsonify({'error': 'Unauthorized'}), 401
 
+    # 使用常數時間比較，避免透過回應時間推測 Secret 內容
     incoming_secret = auth_header[7:]
-    if incoming_secret != KOYEB_SECRET:
+    if not KOYEB_SECRET_BYTES or not hmac.compare_digest(incoming_secret.encode(), KOYEB_SECRET_BYTES):
         logger.warning("無效的 Secret。")
         return jsonify({'error': 'Invalid secret'}), 403
 
     # 解析請求資料
-    data = request.get_json()
+    data = await request.get_json()
     if not data:
         logger.warning("請求中未提供 JSON 資料。")
         return jsonify({'error': 'No JSON data'}), 400
@@ -68,182 +373,477 @@ def wake_handler():
         logger.warning(f"缺少必要參數: url={youtube_url}, chatId={chat_id}")
         return jsonify({'error': 'Missing parameters'}), 400
 
-    # --- 關鍵：背景執行緒 ---
+    if not is_supported_url(youtube_url):
+        logger.warning(f"不支援的網址: {youtube_url}")
+        return jsonify({'error': 'Unsupported URL'}), 400
+
+    # tmpfs 佔用的是記憶體，空間不足時直接拒絕，避免下載到一半才寫滿而失敗
+    tmp_free = shutil.disk_usage(TMPDIR).free
+    if tmp_free < MIN_TMP_FREE_MB << 20:
+        logger.warning(f"暫存目錄剩餘空間不足 ({tmp_free / 1048576:.2f} MB)，拒絕請求: {youtube_url}")
+        return jsonify({'error': 'Insufficient temporary storage'}), 503
+
+    if not QUEUE_DEPTH.acquire(blocking=False):
+        logger.warning(f"下載佇列已滿，拒絕請求: {youtube_url}")
+        return jsonify({'error': 'Server busy'}), 503
+
+    # --- 關鍵：交由共用事件迴圈在背景處理 ---
     try:
-        thread = threading.Thread(
-            target=run_download_and_send,
-            args=(youtube_url, chat_id)
-        )
-        thread.daemon = True
-        thread.start()
-        logger.info(f"已為 URL 啟動背景下載任務: {youtube_url}")
-        return jsonify({'status': 'processing', 'message': 'Download started in background'})
+        future = asyncio.run_coroutine_threadsafe(run_download_and_send(youtube_url, chat_id), LOOP)
+        future.add_done_callback(finish_job)
+        logger.info(f"已將 URL 加入背景下載佇列: {youtube_url}")
+        return jsonify({'status': 'processing', 'message': 'Download started in background'}), 202
     except Exception as e:
-        logger.error(f"啟動下載執行緒時出錯: {e}", exc_info=True)
+        QUEUE_DEPTH.release()
+        logger.error(f"提交下載任務時出錯: {e}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+def finish_job(future):
+    """背景任務結束時釋放佇列名額，並記錄未被處理的例外，避免錯誤只留在沒有人讀取的 future 上。"""
+    QUEUE_DEPTH.release()
+    if future.cancelled():
+        logger.warning("背景下載任務已被取消。")
+        return
+    exc = future.exception()
+    if exc is not None:
+        logger.error(f"背景下載任務發生未處理的錯誤: {exc}", exc_info=exc)
+
 # --- 核心邏輯函式 ---
-def run_download_and_send(youtube_url, chat_id):
+async def run_download_and_send(youtube_url, chat_id):
     """
-    執行緒的目標函式，包裹了完整的下載、壓縮、發送和錯誤處理流程。
+    在共用事件迴圈上執行的背景任務，處理快取命中、重複請求合併以及錯誤回報。
     """
-    final_path = None # 初始化 final_path
+    video_key = extract_video_id(youtube_url)
     try:
+        # 0. 相同影片已上傳過時，直接以 file_id 轉發
+        cached = get_cached_file_id(video_key)
+        if cached:
+            try:
+                await send_cached_video(chat_id, *cached)
+                logger.info(f"命中 file_id 快取，已直接轉發: {video_key}")
+                return
+            except Exception as e:
+                logger.warning(f"快取的 file_id 無法使用，改為重新下載: {e}")
+                discard_cached_file_id(video_key)
+
+        # 1. 相同影片已有任務在處理時，等待其完成後重用它的 file_id
+        task = INFLIGHT.get(video_key)
+        is_owner = task is None
+        if is_owner:
+            task = INFLIGHT[video_key] = asyncio.create_task(process_video(youtube_url, chat_id, video_key))
+            task.add_done_callback(lambda _: INFLIGHT.pop(video_key, None))
+        else:
+            logger.info(f"相同影片已在處理中，等待其結果: {video_key}")
+
+        # 以 shield 等待，避免單一請求被取消時連帶取消其他請求共用的任務
+        result = await asyncio.shield(task)
+        if not is_owner:
+            if not result:
+                raise Exception("相同影片的處理任務未取得可重用的 file_id。")
+            await send_cached_video(chat_id, *result)
+
+    except Exception as e:
+        logger.error(f"處理 URL {youtube_url} 時發生錯誤: {e}", exc_info=True)
+        try:
+            await send_to_telegram(chat_id, None, f"處理影片時出錯了😭\n錯誤訊息: {e}")
+        except Exception:
+            logger.exception(f"無法將錯誤訊息發送到 chat {chat_id}")
+
+
+async def process_video(youtube_url, chat_id, video_key):
+    """
+    取得下載槽位後執行下載與上傳，並快取取得的 file_id 供之後的相同請求直接轉發。
+    """
+    async with JOB_SLOTS:
+        result = await download_and_upload(youtube_url, chat_id)
+    if result:
+        cache_file_id(video_key, *result)
+    return result
+
+
+async def download_and_upload(youtube_url, chat_id):
+    """
+    完整的下載、壓縮與發送流程，返回 (Telegram 回傳的影片 file_id, 是否被截斷)；未取得 file_id 時返回 None。
+    """
+    # 所有臨時檔案 (包括 yt-dlp 的分段與 .part 中間檔) 都放在任務專屬目錄中，不論哪個步驟出錯，離開區塊時整個目錄都會被刪除
+    with job_tempdir() as job_dir:
+        video_path = os.path.join(job_dir, 'video.mp4')
+        compressed_path = os.path.join(job_dir, 'compressed.mp4')
         # 1. 下載影片
-        video_path = download_youtube_video(youtube_url)
-        if not video_path:
-            raise Exception("下載失敗，未返回有效的檔案路徑。")
+        info, transcoded = await download_youtube_video(youtube_url, video_path)
 
         # 2. 檢查檔案大小並視情況壓縮
-        file_size_mb = os.path.getsize(video_path) / (1024 * 1024)
-        logger.info(f"原始檔案大小: {file_size_mb:.2f} MB")
+        file_size = os.stat(video_path).st_size
+        logger.info(f"原始檔案大小: {file_size / 1048576:.2f} MB")
 
         final_path = video_path
-        if file_size_mb > 48:  # 留一點緩衝空間給 50MB 限制
+        truncated = False
+        if transcoded:
+            # 串流轉碼的輸出已是目標位元率，不再進行第二次有損壓縮
+            truncated = reached_size_cap(video_path)
+        elif file_size > COMPRESS_THRESHOLD_BYTES:
             logger.info("檔案過大，開始快速壓縮...")
-            compressed_path = compress_video(video_path)
-            os.remove(video_path)  # 刪除原始大檔案
+            truncated = await compress_video(video_path, compressed_path, info)
+            os.unlink(video_path)  # 提早刪除原始大檔案，釋出暫存空間
             final_path = compressed_path
-            compressed_size_mb = os.path.getsize(final_path) / (1024 * 1024)
-            logger.info(f"壓縮完成，新檔案大小: {compressed_size_mb:.2f} MB")
+            compressed_size = os.stat(final_path).st_size
+            logger.info(f"壓縮完成，新檔案大小: {compressed_size / 1048576:.2f} MB")
+
+        if truncated:
+            logger.warning(f"輸出達到 {ENCODE_SIZE_CAP_BYTES >> 20}MB 上限，影片後段已被截斷: {youtube_url}")
 
         # 3. 發送到 Telegram
-        asyncio.run(send_to_telegram(chat_id, final_path, "您的影片已準備好！"))
+        message = await send_to_telegram(chat_id, final_path, ready_caption(truncated), info)
+        return (message.video.file_id, truncated) if message and message.video else None
 
-    except Exception as e:
-        logger.error(f"處理 URL {youtube_url} 時發生錯誤: {e}", exc_info=True)
-        asyncio.run(send_to_telegram(chat_id, None, f"處理影片時出錯了😭\n錯誤訊息: {e}"))
+
+JOB_TEMPDIR_PREFIX = 'dlbot-'
+
+@contextlib.contextmanager
+def job_tempdir():
+    """配置一個任務專屬的臨時目錄，離開區塊時無論成功或失敗都會連同內容一併刪除。"""
+    path = tempfile.mkdtemp(prefix=JOB_TEMPDIR_PREFIX, dir=TMPDIR)
+    try:
+        yield path
     finally:
-        # 4. 清理臨時檔案
-        if final_path and os.path.exists(final_path):
+        shutil.rmtree(path, ignore_errors=True)
+
+@atexit.register
+def sweep_job_tempdirs():
+    """清除殘留的任務臨時目錄 (例如行程被中斷時來不及刪除的)，於啟動與結束時執行。"""
+    for path in glob.glob(os.path.join(TMPDIR, JOB_TEMPDIR_PREFIX + '*')):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+async def download_youtube_video(url, output_path):
+    """
+    使用 yt-dlp Python API 將影片下載到 output_path。
+    返回 (yt-dlp 的影片資訊, 是否已由 FFmpeg 串流轉碼)，已轉碼的輸出不需要再壓縮。
+    """
+    loop = asyncio.get_running_loop()
+    logger.info(f"開始使用 yt-dlp 下載: {url} -> {output_path}")
+    try:
+        # 格式資訊直接取自同一次擷取結果，不再另外探測格式
+        info = await loop.run_in_executor(EXECUTOR, extract_video_info, url)
+        transcoded = False
+        if can_transcode_stream(info):
+            # 預估會超過大小門檻時，由 FFmpeg 邊下載邊轉碼，不再先落地原始檔
+            logger.info(f"預估檔案約 {estimate_size(info) / 1048576:.2f} MB，直接串流轉碼...")
             try:
-                os.remove(final_path)
-                logger.info(f"已清理臨時檔案: {final_path}")
-            except OSError as e:
-                logger.error(f"清理檔案 {final_path} 失敗: {e}")
-
-
-def download_youtube_video(url):
-    """使用 yt-dlp 下載影片，並返回臨時檔案的路徑。"""
-    temp_filename = f"{uuid.uuid4()}.mp4"
-    temp_path = os.path.join(tempfile.gettempdir(), temp_filename)
-    
-    cmd = [
-        'yt-dlp',
-        '-f', 'bestvideo[height<=720]+bestaudio/best[height<=720]',
-        '--merge-output-format', 'mp4',
-        '--max-filesize', '750M',
-        '--output', temp_path,
-        '--no-warnings',
-        '--socket-timeout', '30',
-        '--retries', '3',
-    ]
-
-    if os.path.exists(COOKIES_PATH) and os.path.getsize(COOKIES_PATH) > 0:
-        cmd.extend(['--cookies', COOKIES_PATH])
-
-    cmd.append(url)
-
-    logger.info(f"執行 yt-dlp 命令: {' '.join(cmd)}")
+                await transcode_stream(info, output_path)
+                transcoded = True
+            except Exception as e:
+                # FFmpeg 不具備 yt-dlp 的重試與 403 處理等機制；失敗時改回由 yt-dlp 下載原始檔，之後再照一般流程壓縮
+                logger.warning(f"串流轉碼失敗，改由 yt-dlp 下載後再壓縮: {e}")
+                try:
+                    os.unlink(output_path)
+                except FileNotFoundError:
+                    pass
+        if not transcoded:
+            await loop.run_in_executor(EXECUTOR, download_with_info, info, output_path)
+    except DownloadCancelled as e:
+        raise Exception(e.msg)
+    except DownloadError as e:
+        raise Exception(f"yt-dlp 下載失敗: {e}")
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"yt-dlp 選用格式: {info.get('format')} ({info.get('width')}x{info.get('height')})")
+
+    # 檔案不存在或大小為 0 (包括 yt-dlp 因超過 max_filesize 而略過) 都視為失敗
+    output_stat = safe_stat(output_path)
+    if not output_stat or output_stat.st_size == 0:
+        raise Exception("yt-dlp 未產生有效的輸出檔案 (可能超過 750M 上限)。")
+    return info, transcoded
+
+def extract_video_info(url):
+    """在工作執行緒中擷取影片資訊並選定格式，不下載。"""
+    return get_ydl().extract_info(url, download=False)
+
+def download_with_info(info, output_path):
+    """在工作執行緒中依已擷取的影片資訊下載到 output_path。"""
+    ydl = get_ydl()
+    # 實例只屬於當前執行緒，請求在其中循序處理，因此可直接改寫本次的輸出路徑
+    ydl.params['outtmpl']['default'] = output_path
+    deadline = _ydl_local.deadline
+    deadline.expires_at = time.monotonic() + DOWNLOAD_TIMEOUT
     try:
-        result = subprocess.run(
-            cmd, check=True, timeout=300, capture_output=True, text=True, encoding='utf-8'
+        ydl.process_ie_result(info, download=True)
+    finally:
+        deadline.expires_at = None
+
+def estimate_size(info):
+    """依 yt-dlp 回報的各格式大小預估下載後的檔案大小 (bytes)，未知時返回 0。"""
+    formats = info.get('requested_formats') or [info]
+    return sum(int(fmt.get('filesize') or fmt.get('filesize_approx') or 0) for fmt in formats)
+
+# FFmpeg 可直接讀取的串流協定 (一般 HTTP 檔案與 HLS 播放清單)
+STREAMABLE_PROTOCOLS = ('http', 'https', 'm3u8', 'm3u8_native')
+
+def can_transcode_stream(info):
+    """
+    判斷是否應改走串流轉碼：需要壓縮、長度已知，且各格式皆為 FFmpeg 可直接讀取的串流。
+    yt-dlp 標記了 http_chunk_size 的格式 (例如 YouTube 的 HTTPS 格式) 必須分段請求才不會被限速，
+    FFmpeg 以單一連線讀取時可能只有接近即時的速度，這類格式一律交給 yt-dlp 下載。
+    """
+    formats = info.get('requested_formats') or [info]
+    return (
+        estimate_size(info) > COMPRESS_THRESHOLD_BYTES
+        and bool(info.get('duration'))
+        and all(
+            fmt.get('url')
+            and fmt.get('protocol') in STREAMABLE_PROTOCOLS
+            and not (fmt.get('downloader_options') or {}).get('http_chunk_size')
+            for fmt in formats
         )
-        logger.info(f"yt-dlp 輸出: {result.stdout}")
-        if result.stderr:
-            logger.warning(f"yt-dlp 錯誤輸出: {result.stderr}")
+    )
 
-        if os.path.getsize(temp_path) > 0:
-            return temp_path
-        else:
-            # 如果檔案大小為 0，也視為失敗並清理
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            raise Exception("下載的檔案大小為 0。")
-
-    except subprocess.TimeoutExpired:
-        if os.path.exists(temp_path): os.remove(temp_path)
-        raise Exception("下載超時 (超過 300 秒)。")
-    except subprocess.CalledProcessError as e:
-        if os.path.exists(temp_path): os.remove(temp_path)
-        error_message = e.stderr or e.stdout
-        raise Exception(f"yt-dlp 下載失敗: {error_message.strip()}")
-
-def compress_video(input_path):
-    """
-    使用 FFmpeg 快速壓縮影片 (單階段 CRF)。
-    """
-    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_file:
-        output_path = temp_file.name
-    
+def target_video_bitrate_k(duration):
+    """依影片長度計算能讓輸出落在 -fs 上限內的視訊位元率 (kbps)。"""
+    total_k = (ENCODE_SIZE_CAP_BYTES >> 10) * 8 * 0.95 / duration
+    return max(int(total_k - AUDIO_BITRATE_K), 100)
+
+def can_stream_copy(info, bitrate_k):
+    """
+    判斷來源是否已是 H.264，且視訊位元率超出 bitrate_k 不到 5%，視訊可直接 stream copy。
+    bitrate_k 已扣除 AUDIO_BITRATE_K 的音訊預算，因此音訊必須重新編碼為該位元率。
+    """
+    formats = info.get('requested_formats') or [info]
+    video = next((fmt for fmt in formats if fmt.get('vcodec') not in (None, 'none')), None)
+    if video is None:
+        return False
+    source_bitrate = video.get('vbr') or video.get('tbr')
+    return (
+        bool(source_bitrate)
+        and video['vcodec'].startswith(('avc1', 'h264'))
+        and source_bitrate <= bitrate_k * 1.05
+    )
+
+def reached_size_cap(path):
+    """以 -fs 編碼的輸出達到上限時，代表 FFmpeg 提早停止，影片後段已被截斷。"""
+    return os.stat(path).st_size >= ENCODE_SIZE_CAP_BYTES
+
+class FFmpegError(Exception):
+    """FFmpeg 以非零結束碼結束。"""
+
+    def __init__(self, returncode, stderr):
+        super().__init__(f"結束碼 {returncode} - {stderr}")
+        self.returncode = returncode
+        self.stderr = stderr
+
+class FFmpegTimeoutError(Exception):
+    """FFmpeg 執行超過時限而被終止。"""
+
+# FFmpeg 無法讀取輸入來源時的錯誤訊息 (例如網址回應 403)，換編碼器重試也會以相同方式失敗
+_FFMPEG_INPUT_ERROR_RE = re.compile(
+    r'Server returned|Error opening input|Input/output error|Connection (?:refused|reset|timed out)'
+)
+
+async def run_ffmpeg(ffmpeg_cmd, timeout):
+    """以非同步子行程執行 FFmpeg，不佔用執行緒；失敗或超時時拋出帶有錯誤輸出的例外。"""
+    # 在獨立的 session (行程群組) 中啟動，超時時可一併終止 FFmpeg 衍生的所有子行程
+    proc = await asyncio.create_subprocess_exec(
+        *ffmpeg_cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE, start_new_session=True
+    )
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise FFmpegTimeoutError(f"執行超時 (超過 {timeout} 秒)。")
+    finally:
+        # 超時或任務被取消 (例如服務關閉) 時 FFmpeg 仍在執行，終止整個行程群組，不留下脫離的子行程
+        if proc.returncode is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+    if proc.returncode != 0:
+        raise FFmpegError(proc.returncode, stderr.decode('utf-8', errors='replace').strip())
+
+async def run_encode(build_cmd, timeout):
+    """
+    以偵測到的硬體編碼器執行 build_cmd(encoder) 產生的 FFmpeg 命令；
+    硬體編碼失敗時 (驅動或裝置在執行期間出問題) 改用 libx264 重試一次。
+    超時或輸入來源無法讀取時直接拋出，重試只會再耗費同樣的時間與下載槽位。
+    """
+    if H264_ENCODER:
+        try:
+            await run_ffmpeg(build_cmd(H264_ENCODER), timeout)
+            return
+        except FFmpegError as e:
+            if _FFMPEG_INPUT_ERROR_RE.search(e.stderr):
+                raise
+            logger.warning(f"硬體編碼器 {H264_ENCODER} 編碼失敗，改用 libx264 重試: {e}")
+    await run_ffmpeg(build_cmd(None), timeout)
+
+async def transcode_stream(info, output_path):
+    """
+    讓 FFmpeg 直接讀取 yt-dlp 解析出的串流網址，邊下載邊轉碼成目標位元率的 MP4。
+    """
+    formats = info.get('requested_formats') or [info]
+    bitrate = target_video_bitrate_k(info['duration'])
+
+    def build_cmd(encoder):
+        ffmpeg_cmd = [FFMPEG_BIN, '-y', *FFMPEG_QUIET_ARGS, *hw_device_args(encoder)]
+        for fmt in formats:
+            headers = ''.join(f"{k}: {v}\r\n" for k, v in (fmt.get('http_headers') or {}).items())
+            if headers:
+                ffmpeg_cmd.extend(['-headers', headers])
+            ffmpeg_cmd.extend(['-i', fmt['url']])
+        ffmpeg_cmd.extend([
+            '-map', '0:v:0',
+            '-map', f'{len(formats) - 1}:a:0?',
+            *video_encoder_args(encoder, bitrate),
+            '-c:a', 'aac',
+            '-b:a', f'{AUDIO_BITRATE_K}k',
+            # 由 FFmpeg 直接保證輸出不超過大小門檻，位元率估算偏差時也不會超出 Telegram 的限制
+            '-fs', str(ENCODE_SIZE_CAP_BYTES),
+            # 將 moov 移到檔頭，Telegram 可邊下載邊播放
+            '-movflags', '+faststart',
+            output_path
+        ])
+        return ffmpeg_cmd
+
+    logger.info(f"執行 FFmpeg 串流轉碼 (編碼器 {H264_ENCODER or 'libx264'}，目標視訊位元率 {bitrate}k)")
     try:
-        # 使用單階段 CRF 編碼，速度遠快於兩階段
-        # -crf 24: 一個很好的品質與檔案大小的平衡點 (數值越高品質越低)
-        # -preset superfast: 比 'fast' 更快，犧牲少量壓縮率換取大量時間
-        ffmpeg_cmd = [
-            'ffmpeg',
+        await run_encode(build_cmd, timeout=900)
+    except Exception as e:
+        raise Exception(f"FFmpeg 串流轉碼失敗: {e}")
+
+async def compress_video(input_path, output_path, info):
+    """
+    使用 FFmpeg 快速壓縮影片到 output_path (單階段，優先使用硬體編碼器)，返回輸出是否因大小上限而被截斷。
+    影片長度取自下載時 yt-dlp 回報的資訊，用來推算目標位元率，無須再另外探測檔案。
+    """
+    duration = info.get('duration')
+    bitrate = target_video_bitrate_k(duration) if duration else FALLBACK_VIDEO_BITRATE_K
+
+    if duration and can_stream_copy(info, bitrate):
+        # 來源已是位元率足夠低的 H.264，視訊只需重新封裝，不必解碼再編碼；
+        # YouTube 的音訊多在 130-160k，需轉成 AUDIO_BITRATE_K 的 AAC 才能符合位元率預算
+        logger.info("來源視訊位元率已在目標範圍內，視訊改用 stream copy...")
+        remux_cmd = [
+            FFMPEG_BIN, '-y', *FFMPEG_QUIET_ARGS,
+            '-i', input_path,
+            '-c:v', 'copy',
+            '-c:a', 'aac',
+            '-b:a', f'{AUDIO_BITRATE_K}k',
+            '-movflags', '+faststart',
+            output_path
+        ]
+        try:
+            await run_ffmpeg(remux_cmd, timeout=600)
+            output_stat = safe_stat(output_path)
+            if output_stat and output_stat.st_size <= COMPRESS_THRESHOLD_BYTES:
+                return False
+            logger.info("stream copy 後仍超過大小門檻，改為重新編碼...")
+        except Exception as e:
+            logger.warning(f"FFmpeg stream copy 失敗，改為重新編碼: {e}")
+
+    # 使用單階段編碼，速度遠快於兩階段
+    def build_cmd(encoder):
+        return [
+            FFMPEG_BIN,
             '-y',
+            *FFMPEG_QUIET_ARGS,
+            *hw_device_args(encoder),
             '-i', input_path,
-            '-c:v', 'libx264',
-            '-crf', '24',
-            '-preset', 'superfast',
+            *video_encoder_args(encoder, bitrate),
             '-c:a', 'aac',
-            '-b:a', '128k',
+            '-b:a', f'{AUDIO_BITRATE_K}k',
+            '-fs', str(ENCODE_SIZE_CAP_BYTES),
+            '-movflags', '+faststart',
             output_path
         ]
-        
-        logger.info(f"執行 FFmpeg 單階段壓縮命令: {' '.join(ffmpeg_cmd)}")
-        
-        # 執行壓縮，設定 10 分鐘超時
-        subprocess.run(ffmpeg_cmd, check=True, timeout=600, capture_output=True, text=True, encoding='utf-8')
 
-        return output_path
+    logger.info(f"執行 FFmpeg 單階段壓縮命令: {' '.join(build_cmd(H264_ENCODER))}")
 
+    # 執行壓縮，設定 10 分鐘超時
+    try:
+        await run_encode(build_cmd, timeout=600)
     except Exception as e:
-        # 如果壓縮出錯，清理輸出的臨時檔
-        if os.path.exists(output_path):
-            os.remove(output_path)
-        
-        # 提取更詳細的 FFmpeg 錯誤
-        error_details = ""
-        if isinstance(e, subprocess.CalledProcessError):
-            error_details = e.stderr or e.stdout
-        raise Exception(f"FFmpeg 壓縮失敗: {e} - {error_details}")
-
-async def send_to_telegram(chat_id, file_path, caption):
-    """發送檔案或文字訊息到 Telegram。"""
-    if not TELEGRAM_TOKEN:
+        raise Exception(f"FFmpeg 壓縮失敗: {e}")
+    return reached_size_cap(output_path)
+
+class UploadMmap(mmap.mmap):
+    """seek() 會返回新位置的 mmap (Python 3.13 以前返回 None)，讓 httpx 能算出 Content-Length，不必改用 chunked 上傳。"""
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        super().seek(pos, whence)
+        return self.tell()
+
+class MmapInputFile(InputFile):
+    """
+    以 mmap 作為內容的 InputFile。
+    InputFile 收到檔案物件時會先 read() 成完整的 bytes；改交給 httpx 一個可 seek/read 的 mmap，
+    上傳時便會以 64KB 為單位分段讀取，不會在記憶體中多出一份完整的檔案副本。
+    """
+    __slots__ = ()
+
+    def __init__(self, mm, filename):
+        super().__init__(b'', filename=filename)
+        self.input_file_content = mm
+
+async def send_to_telegram(chat_id, file_path, caption, info=None):
+    """
+    發送檔案或文字訊息到 Telegram，成功發送影片時返回該 Message。
+    info 為 yt-dlp 的影片資訊，用來提供影片長度與解析度。
+    """
+    if BOT is None:
         logger.error("TELEGRAM_TOKEN 未設定，無法發送訊息。")
         return
-    bot = Bot(token=TELEGRAM_TOKEN)
-    
-    if file_path and os.path.exists(file_path):
-        file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-        if file_size_mb > 50:
-            error_msg = f"檔案太大 ({file_size_mb:.2f} MB)，Telegram 拒絕傳送。"
+
+    file_stat = safe_stat(file_path) if file_path else None
+    if file_stat:
+        if file_stat.st_size > TELEGRAM_UPLOAD_LIMIT_BYTES:
+            error_msg = f"檔案太大 ({file_stat.st_size / 1048576:.2f} MB)，Telegram 拒絕傳送。"
             logger.error(error_msg)
-            await bot.send_message(chat_id=chat_id, text=error_msg)
+            await BOT.send_message(chat_id=chat_id, text=error_msg)
             return
 
-        with open(file_path, 'rb') as video_file:
-            await bot.send_video(
+        info = info or {}
+        duration = info.get('duration')
+        # 以唯讀 mmap 映射檔案，httpx 直接從 page cache 分段讀取上傳，不必先把整個檔案讀成 bytes
+        with open(file_path, 'rb') as f, UploadMmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # 讀寫超時沿用 TELEGRAM_REQUEST 中為大檔案上傳設定的 120 秒
+            # 直接提供長度與解析度並標示可串流，Telegram 無須自行探測，用戶端也能邊下載邊播放
+            return await BOT.send_video(
                 chat_id=chat_id,
-                video=video_file,
+                video=MmapInputFile(mm, filename=os.path.basename(file_path)),
                 caption=caption,
-                read_timeout=60, # 增加超時時間
-                write_timeout=60
+                supports_streaming=True,
+                duration=int(duration) if duration else None,
+                width=info.get('width'),
+                height=info.get('height')
             )
     else:
         # 如果沒有檔案路徑 (例如發生錯誤時)，只發送文字訊息
-        await bot.send_message(
+        await BOT.send_message(
             chat_id=chat_id,
             text=caption,
             read_timeout=20,
             write_timeout=20
         )
 
+def ready_caption(truncated):
+    """影片發送時的說明文字，影片因大小上限被截斷時附上提醒。"""
+    caption = "您的影片已準備好！"
+    if truncated:
+        caption += "\n⚠️ 影片超過大小上限，只保留了前段內容。"
+    return caption
+
+async def send_cached_video(chat_id, file_id, truncated):
+    """以 Telegram 伺服器上既有的 file_id 發送影片，不需重新上傳；說明文字依快取的截斷狀態產生。"""
+    if BOT is None:
+        logger.error("TELEGRAM_TOKEN 未設定，無法發送訊息。")
+        return
+    return await BOT.send_video(chat_id=chat_id, video=file_id, caption=ready_caption(truncated))
+
 # --- 主程式入口 ---
 if __name__ == '__main__':
-    # 在生產環境中，建議使用 Waitress 或 Gunicorn
+    warmup()
+    init_bot()
+    signal.signal(signal.SIGHUP, reload_cookies)
+    # 使用 uvicorn 作為 ASGI 伺服器，以 uvloop 處理事件迴圈、httptools 解析 HTTP
+    # 僅啟動單一 worker：file_id 快取、進行中任務與背景事件迴圈都是行程內狀態
     logger.info("服務啟動於 http://0.0.0.0:8080")
-    serve(app, host='0.0.0.0', port=8080)
+    uvicorn.run(app, host='0.0.0.0', port=8080, loop='uvloop', http='httptools', workers=1)